@@ -1,25 +1,47 @@
-"""Utility functions related to Bayesian inversion."""
+"""Utility functions related to Bayesian inversion.
+
+Guidance score functions are jitted, but do not enable JAX's persistent compilation cache
+themselves. Call `diffusionlib.util.compilation.enable_compilation_cache` before building them
+to reuse their compiled executables across processes.
+"""
 
 from abc import ABC, abstractmethod
 from dataclasses import dataclass, field, fields, is_dataclass
 from enum import StrEnum, auto
-from typing import Callable
+from functools import cache, cached_property
+from math import prod
+from types import MappingProxyType
+from typing import Callable, Mapping
 
 import jax.numpy as jnp
-from jax import grad, jacfwd, jacrev, vjp, vmap
+from jax import (
+    checkpoint,
+    checkpoint_policies,
+    jacfwd,
+    jacrev,
+    jit,
+    lax,
+    random,
+    vjp,
+    vmap,
+)
 from jaxtyping import Array
 
 from diffusionlib.sde import RVE, RVP
 from diffusionlib.util.misc import (
+    batch_cho_solve_A,
     batch_linalg_solve,
-    batch_linalg_solve_A,
     batch_matmul,
     batch_matmul_A,
     batch_mul,
-    batch_mul_A,
+    chunked_map,
 )
 
-__CONDITIONING_METHOD__: dict["ConditioningMethodName", type["ConditioningMethod"]] = {}
+_conditioning_method_registry: dict["ConditioningMethodName", type["ConditioningMethod"]] = {}
+# Read-only view of the registry; methods are only added through `register_conditioning_method`
+__CONDITIONING_METHOD__: Mapping["ConditioningMethodName", type["ConditioningMethod"]] = (
+    MappingProxyType(_conditioning_method_registry)
+)
 
 
 class ConditioningMethodName(StrEnum):
@@ -35,29 +57,141 @@ class ConditioningMethodName(StrEnum):
     JAC_REV_GUIDANCE_DIAG = auto()
     JAC_FWD_GUIDANCE = auto()
     JAC_FWD_GUIDANCE_DIAG = auto()
+    # Resolved to the forward or reverse mode variant depending on the problem dimensions
+    JAC_GUIDANCE = auto()
+    JAC_GUIDANCE_DIAG = auto()
+
+
+# Jacobian guidance methods mapped to their (forward mode, reverse mode) implementations
+__JACOBIAN_CONDITIONING_METHOD__: dict[
+    ConditioningMethodName, tuple[ConditioningMethodName, ConditioningMethodName]
+] = {
+    ConditioningMethodName.JAC_GUIDANCE: (
+        ConditioningMethodName.JAC_FWD_GUIDANCE,
+        ConditioningMethodName.JAC_REV_GUIDANCE,
+    ),
+    ConditioningMethodName.JAC_GUIDANCE_DIAG: (
+        ConditioningMethodName.JAC_FWD_GUIDANCE_DIAG,
+        ConditioningMethodName.JAC_REV_GUIDANCE_DIAG,
+    ),
+}
 
 
 def register_conditioning_method(name: ConditioningMethodName):
     def wrapper(cls):
         if __CONDITIONING_METHOD__.get(name):
             raise NameError(f"Name {name} is already registered!")
-        __CONDITIONING_METHOD__[name] = cls
+        _conditioning_method_registry[name] = cls
         return cls
 
     return wrapper
 
 
 def get_conditioning_method(name: ConditioningMethodName, **kwargs):
+    if (jacobian_methods := __JACOBIAN_CONDITIONING_METHOD__.get(name)) is not None:
+        name = _select_jacobian_method(*jacobian_methods, shape=kwargs["shape"], y=kwargs["y"])
+
     if (cond_method_class := __CONDITIONING_METHOD__.get(name)) is None:
         raise NameError(f"Name {name} is not defined!")
 
-    class_fields = {field.name for field in fields(cond_method_class)}
+    class_fields = _field_names(cond_method_class)
     params = {field: value for field, value in kwargs.items() if field in class_fields}
 
     return cond_method_class(**params)
 
 
-@dataclass
+@cache
+def _field_names(cond_method_class: type["ConditioningMethod"]) -> frozenset[str]:
+    return frozenset(field.name for field in fields(cond_method_class))
+
+
+def _remat(
+    estimate_x_0: Callable[[Array, Array], tuple[Array, tuple[Array, Array]]],
+) -> Callable[[Array, Array], tuple[Array, tuple[Array, Array]]]:
+    # Recompute the score network's forward pass in the backward pass, so only its inputs (and
+    # not its activations) are kept alive across the vjp boundary. Only useful for reverse mode
+    return checkpoint(estimate_x_0, policy=checkpoint_policies.nothing_saveable)
+
+
+def _with_primal(
+    estimate_h_x_0: Callable[[Array, Array], tuple[Array, tuple[Array, Array]]],
+) -> Callable[[Array, Array], tuple[Array, tuple[Array, Array]]]:
+    # Also return h(x_0) and the score as auxiliary data, so that a jacobian transformation with
+    # `has_aux=True` gives the primal outputs from the same score network evaluation
+    def h_x_0_with_primal(x: Array, t: Array) -> tuple[Array, tuple[Array, Array]]:
+        h_x_0, (s, _) = estimate_h_x_0(x, t)
+        return h_x_0, (h_x_0, s)
+
+    return h_x_0_with_primal
+
+
+def _batch_batch(observation_map: Callable[[Array], Array]) -> Callable[[Array], Array]:
+    # Equivalent to `vmap(vmap(observation_map))`, but flattens the two leading axes so only a
+    # single vmap is needed
+    batch_observation_map = vmap(observation_map)
+
+    def batch_batch_observation_map(x: Array) -> Array:
+        out = batch_observation_map(x.reshape((-1,) + x.shape[2:]))
+        return out.reshape(x.shape[:2] + out.shape[1:])
+
+    return batch_batch_observation_map
+
+
+def _broadcast_vjp(
+    vjp_x_0: Callable[[Array], tuple[Array]], shape: tuple[int, ...]
+) -> Callable[[Array], Array]:
+    # vjp of a single (unbatched) cotangent, broadcast over the batch under trace so that mapping
+    # over the rows of H does not materialise a (d_y, B, ...) copy of it
+    def h_vjp(h: Array) -> Array:
+        return vjp_x_0(jnp.broadcast_to(h, shape))[0].reshape(shape[0], -1)
+
+    return h_vjp
+
+
+def _get_hutchinson_diagonal_guidance_score(
+    cond: "JacRevDiagonal | JacFwdDiagonal",
+) -> Callable[[Array, Array], Array]:
+    # Diagonal guidance where diag(H J H^T) is estimated as the mean of z * H (H J)^T z over
+    # Rademacher probes z, so only vjps are needed rather than the full jacobian
+    estimate_h_x_0 = _remat(cond.sde.get_estimate_x_0(cond.observation_map))
+    batch_observation_map = vmap(cond.observation_map)
+    key = random.PRNGKey(cond.seed)
+
+    @jit
+    def guidance_score(x, t):
+        ratio_t = cond.sde.ratio(t[0])
+        h_x_0, vjp_h_x_0, (s, _) = vjp(lambda x: estimate_h_x_0(x, t), x, has_aux=True)
+        # Fresh (but reproducible) probes for each time
+        step_key = random.fold_in(
+            key, lax.bitcast_convert_type(jnp.ravel(t)[0].astype(jnp.float32), jnp.uint32)
+        )
+        zs = random.rademacher(step_key, (cond.num_probes,) + h_x_0.shape, dtype=h_x_0.dtype)
+        diag = jnp.mean(vmap(lambda z: z * batch_observation_map(vjp_h_x_0(z)[0]))(zs), axis=0)
+        # The exact diagonal is non-negative, but the estimate need not be; clamp it so that C_yy
+        # stays positive
+        diag = jnp.maximum(diag, 0.0)
+        C_yy = ratio_t * diag + cond.noise_std**2
+        ls = vjp_h_x_0((cond.y - h_x_0) / C_yy)[0]
+        gs = s + ls
+        return gs
+
+    return guidance_score
+
+
+def _select_jacobian_method(
+    fwd_name: ConditioningMethodName,
+    rev_name: ConditioningMethodName,
+    shape: tuple[int, ...],
+    y: Array,
+) -> ConditioningMethodName:
+    # Forward mode costs d_x jvps and reverse mode d_y vjps; pick whichever needs fewer
+    d_x = prod(shape[1:])
+    d_y = y.shape[1]
+
+    return fwd_name if d_x <= d_y else rev_name
+
+
+@dataclass(frozen=True)
 class ConditioningMethod(ABC):
     sde: RVE | RVP
     y: Array
@@ -70,11 +204,15 @@ class ConditioningMethod(ABC):
     @property
     @abstractmethod
     def guidance_score_func(self) -> Callable[[Array, Array], Array]:
+        """Guidance score function. Implementations build it once per instance (as a
+        `cached_property`), so repeated access reuses the same closure and its compiled cache.
+        Conditioning methods are frozen, as their fields are baked into that compiled function.
+        """
         raise NotImplementedError
 
 
 @register_conditioning_method(ConditioningMethodName.DIFFUSION_POSTERIOR_SAMPLING)
-@dataclass
+@dataclass(frozen=True)
 class DPS(ConditioningMethod):
     """
     Implementation of score guidance suggested in
@@ -82,7 +220,7 @@ class DPS(ConditioningMethod):
     Chung et al. 2022,
     https://github.com/DPS2022/diffusion-posterior-sampling/blob/main/guided_diffusion/condition_methods.py
 
-    Computes a single (batched) gradient.
+    Computes a single (batched) vjp.
 
     NOTE: This is not how Chung et al. 2022 implemented their method, but is a related
     continuous time method.
@@ -95,30 +233,25 @@ class DPS(ConditioningMethod):
     observation_map: Callable[[Array], Array]
     scale: float
 
-    @property
+    @cached_property
     def guidance_score_func(self) -> Callable[[Array, Array], Array]:
-        def get_l2_norm(y, estimate_h_x_0):
-            def l2_norm(x, t):
-                h_x_0, (s, _) = estimate_h_x_0(x, t)
-                innovation = y - h_x_0
-                return jnp.linalg.norm(innovation), s
-
-            return l2_norm
-
-        estimate_h_x_0 = self.sde.get_estimate_x_0(self.observation_map)
-        l2_norm = get_l2_norm(self.y, estimate_h_x_0)
-        likelihood_score = grad(l2_norm, has_aux=True)
+        estimate_h_x_0 = _remat(self.sde.get_estimate_x_0(self.observation_map))
 
+        @jit
         def guidance_score(x, t):
-            ls, s = likelihood_score(x, t)
-            gs = s - self.scale * ls
+            h_x_0, vjp_estimate_h_x_0, (s, _) = vjp(lambda x: estimate_h_x_0(x, t), x, has_aux=True)
+            innovation = self.y - h_x_0
+            # -grad ||innovation|| = J^T innovation / ||innovation||, computed via a single vjp
+            # rather than differentiating through the norm (guarded against a zero innovation)
+            ls = vjp_estimate_h_x_0(innovation / (jnp.sqrt(jnp.sum(innovation**2)) + 1e-12))[0]
+            gs = s + self.scale * ls
             return gs
 
         return guidance_score
 
 
 @register_conditioning_method(ConditioningMethodName.DIFFUSION_POSTERIOR_SAMPLING_MOD)
-@dataclass
+@dataclass(frozen=True)
 class DPSMod(ConditioningMethod):
     """
     Implementation of score guidance suggested in
@@ -138,18 +271,17 @@ class DPSMod(ConditioningMethod):
     observation_map: Callable[[Array], Array]
     noise_std: float
 
-    @property
+    @cached_property
     def guidance_score_func(self) -> Callable[[Array, Array], Array]:
-        estimate_h_x_0 = self.sde.get_estimate_x_0(self.observation_map)
+        estimate_h_x_0 = _remat(self.sde.get_estimate_x_0(self.observation_map))
 
+        @jit
         def guidance_score(x, t):
             h_x_0, vjp_estimate_h_x_0, (s, _) = vjp(lambda x: estimate_h_x_0(x, t), x, has_aux=True)
-            innovation = self.y - h_x_0
             C_yy = (
                 self.noise_std**2
             )  # TODO: could investigate replacing with jnp.linalg.norm(innovation**2)
-            ls = innovation / C_yy
-            ls = vjp_estimate_h_x_0(ls)[0]
+            ls = vjp_estimate_h_x_0((self.y - h_x_0) / C_yy)[0]
             gs = s + ls
             return gs
 
@@ -157,7 +289,7 @@ class DPSMod(ConditioningMethod):
 
 
 @register_conditioning_method(ConditioningMethodName.PSEUDO_INVERSE_GUIDANCE)
-@dataclass
+@dataclass(frozen=True)
 class PIG(ConditioningMethod):
     """
     `Pseudo-Inverse guided diffusion models for inverse problems`
@@ -174,28 +306,32 @@ class PIG(ConditioningMethod):
     noise_std: float
     HHT: Array = field(default_factory=lambda: jnp.array([1.0]))
 
-    @property
+    def __post_init__(self):
+        if self.HHT.shape not in ((self.y.shape[1], self.y.shape[1]), (1,)):
+            raise ValueError(f"Bad shape for {self.HHT.shape=}")
+
+    @cached_property
     def guidance_score_func(self) -> Callable[[Array, Array], Array]:
-        estimate_h_x_0 = self.sde.get_estimate_x_0(self.observation_map)
+        estimate_h_x_0 = _remat(self.sde.get_estimate_x_0(self.observation_map))
+        data_variance = jnp.array(1.0)
 
-        def guidance_score(x, t):
-            h_x_0, vjp_estimate_h_x_0, (s, _) = vjp(lambda x: estimate_h_x_0(x, t), x, has_aux=True)
-            innovation = self.y - h_x_0
+        # Pick the C_yy solve for the shape of HHT once, rather than on every call
+        if self.HHT.shape == (1,):
 
-            if self.HHT.shape == (self.y.shape[1], self.y.shape[1]):
-                C_yy = self.sde.r2(
-                    t[0], data_variance=jnp.array(1.0)
-                ) * self.HHT + self.noise_std**2 * jnp.eye(self.y.shape[1])
-                f = batch_linalg_solve_A(C_yy, innovation)
-            elif self.HHT.shape == (1,):
-                C_yy = (
-                    self.sde.r2(t[0], data_variance=jnp.array(1.0)) * self.HHT + self.noise_std**2
-                )
-                f = innovation / C_yy
-            else:
-                raise ValueError(f"Bad shape for {self.HHT.shape=}")
+            def solve_cov(r2, innovation):
+                return innovation / (r2 * self.HHT + self.noise_std**2)
+
+        else:
+            noise_cov = self.noise_std**2 * jnp.eye(self.y.shape[1])
 
-            ls = vjp_estimate_h_x_0(f)[0]
+            def solve_cov(r2, innovation):
+                return batch_cho_solve_A(r2 * self.HHT + noise_cov, innovation)
+
+        @jit
+        def guidance_score(x, t):
+            h_x_0, vjp_estimate_h_x_0, (s, _) = vjp(lambda x: estimate_h_x_0(x, t), x, has_aux=True)
+            r2 = self.sde.r2(t[0], data_variance=data_variance)
+            ls = vjp_estimate_h_x_0(solve_cov(r2, self.y - h_x_0))[0]
             gs = s + ls
 
             return gs
@@ -204,12 +340,13 @@ class PIG(ConditioningMethod):
 
 
 @register_conditioning_method(ConditioningMethodName.VJP_GUIDANCE_ALT)
-@dataclass
+@dataclass(frozen=True)
 class VJPAlt(ConditioningMethod):
     """
     Uses full second moment approximation of the covariance of x_0|x_t.
 
-    Computes using H.shape[0] vjps.
+    Computes using H.shape[0] vjps, evaluated in parallel. Set `vjp_chunk_size` to instead
+    evaluate them sequentially in chunks of that size, to bound peak memory.
 
     NOTE: Alternate implementation to `meth:get_vjp_guidance` that does all reshaping here.
     """
@@ -217,24 +354,23 @@ class VJPAlt(ConditioningMethod):
     H: Array
     noise_std: float
     shape: tuple[int, ...]
+    vjp_chunk_size: int | None = None
 
-    @property
+    @cached_property
     def guidance_score_func(self) -> Callable[[Array, Array], Array]:
-        estimate_x_0 = self.sde.get_estimate_x_0(lambda x: x)
+        estimate_x_0 = _remat(self.sde.get_estimate_x_0(lambda x: x))
         _shape = (self.H.shape[0],) + self.shape[1:]
-        axes = (1, 0) + tuple(range(len(self.shape) + 1)[2:])
-        batch_H = jnp.transpose(
-            jnp.tile(self.H.reshape(_shape), (self.shape[0],) + len(self.shape) * (1,)), axes=axes
-        )
+        noise_cov = self.noise_std**2 * jnp.eye(self.y.shape[1])
 
+        @jit
         def guidance_score(x, t):
+            ratio_t = self.sde.ratio(t[0])
             x_0, vjp_x_0, (s, _) = vjp(lambda x: estimate_x_0(x, t), x, has_aux=True)
-            vec_vjp_x_0 = vmap(vjp_x_0)
-            H_grad_x_0 = vec_vjp_x_0(batch_H)[0]
+            H_grad_x_0 = chunked_map(
+                _broadcast_vjp(vjp_x_0, self.shape), self.H.reshape(_shape), self.vjp_chunk_size
+            )
             H_grad_x_0 = H_grad_x_0.reshape(self.H.shape[0], self.shape[0], self.H.shape[1])
-            C_yy = self.sde.ratio(t[0]) * batch_matmul_A(
-                self.H, H_grad_x_0.transpose(1, 2, 0)
-            ) + self.noise_std**2 * jnp.eye(self.y.shape[1])
+            C_yy = ratio_t * batch_matmul_A(self.H, H_grad_x_0.transpose(1, 2, 0)) + noise_cov
             innovation = self.y - batch_matmul_A(self.H, x_0.reshape(self.shape[0], -1))
             f = batch_linalg_solve(C_yy, innovation)
             ls = vjp_x_0(batch_matmul_A(self.H.T, f).reshape(self.shape))[0]
@@ -245,36 +381,41 @@ class VJPAlt(ConditioningMethod):
 
 
 @register_conditioning_method(ConditioningMethodName.VJP_GUIDANCE)
-@dataclass
+@dataclass(frozen=True)
 class VJP(ConditioningMethod):
     """
     Uses full second moment approximation of the covariance of x_0|x_t.
 
-    Computes using H.shape[0] vjps.
+    Computes using H.shape[0] vjps, evaluated in parallel. Set `vjp_chunk_size` to instead
+    evaluate them sequentially in chunks of that size, to bound peak memory.
     """
 
     H: Array
     noise_std: float
     shape: tuple[int, ...]
+    vjp_chunk_size: int | None = None
 
-    @property
+    @cached_property
     def guidance_score_func(self) -> Callable[[Array, Array], Array]:
         # TODO: necessary to use shape here?
-        estimate_x_0 = self.sde.get_estimate_x_0(lambda x: x, shape=(self.shape[0], -1))
-        batch_H = jnp.transpose(jnp.tile(self.H, (self.shape[0], 1, 1)), axes=(1, 0, 2))
+        estimate_x_0 = _remat(self.sde.get_estimate_x_0(lambda x: x, shape=(self.shape[0], -1)))
+        noise_cov = self.noise_std**2 * jnp.eye(self.y.shape[1])
 
+        @jit
         def guidance_score(x, t):
+            ratio_t = self.sde.ratio(t[0])
             x_0, vjp_x_0, (s, _) = vjp(lambda x: estimate_x_0(x, t), x, has_aux=True)
-            vec_vjp_x_0 = vmap(vjp_x_0)
-            H_grad_x_0 = vec_vjp_x_0(batch_H)[0]
-            H_grad_x_0 = H_grad_x_0.reshape(self.H.shape[0], self.shape[0], self.H.shape[1])
-            C_yy = self.sde.ratio(t[0]) * batch_matmul_A(
-                self.H, H_grad_x_0.transpose(1, 2, 0)
-            ) + self.noise_std**2 * jnp.eye(self.y.shape[1])
+            # (d_y, B, d_x) Jacobian-matrix product, contracted directly without transposing
+            H_grad_x_0 = chunked_map(
+                _broadcast_vjp(vjp_x_0, (self.shape[0], self.H.shape[1])),
+                self.H,
+                self.vjp_chunk_size,
+            )
+            C_yy = ratio_t * jnp.einsum("ij,kbj->bik", self.H, H_grad_x_0) + noise_cov
             innovation = self.y - batch_matmul_A(self.H, x_0)
             f = batch_linalg_solve(C_yy, innovation)
             # NOTE: in some early tests it's faster to calculate via H_grad_x_0, instead of another vjp
-            ls = batch_matmul(H_grad_x_0.transpose(1, 2, 0), f).reshape(s.shape)
+            ls = jnp.einsum("kbi,bk->bi", H_grad_x_0, f).reshape(s.shape)
             # ls = vjp_x_0(batch_matmul_A(H.T, f))[0]
             gs = s + ls
             return gs
@@ -283,7 +424,7 @@ class VJP(ConditioningMethod):
 
 
 @register_conditioning_method(ConditioningMethodName.VJP_GUIDANCE_MASK)
-@dataclass
+@dataclass(frozen=True)
 class VJPMask(ConditioningMethod):
     """
     Uses row sum of second moment approximation of the covariance of x_0|x_t.
@@ -295,18 +436,18 @@ class VJPMask(ConditioningMethod):
     noise_std: float
     shape: tuple[int, ...]
 
-    @property
+    @cached_property
     def guidance_score_func(self) -> Callable[[Array, Array], Array]:
-        estimate_h_x_0 = self.sde.get_estimate_x_0(self.observation_map)
+        estimate_h_x_0 = _remat(self.sde.get_estimate_x_0(self.observation_map))
         batch_observation_map = vmap(self.observation_map)
 
+        @jit
         def guidance_score(x, t):
+            ratio_t = self.sde.ratio(t[0])
             h_x_0, vjp_h_x_0, (s, _) = vjp(lambda x: estimate_h_x_0(x, t), x, has_aux=True)
             diag = batch_observation_map(vjp_h_x_0(batch_observation_map(jnp.ones_like(x)))[0])
-            C_yy = self.sde.ratio(t[0]) * diag + self.noise_std**2
-            innovation = self.y - h_x_0
-            ls = innovation / C_yy
-            ls = vjp_h_x_0(ls)[0]
+            C_yy = ratio_t * diag + self.noise_std**2
+            ls = vjp_h_x_0((self.y - h_x_0) / C_yy)[0]
             gs = s + ls
             return gs
 
@@ -314,7 +455,7 @@ class VJPMask(ConditioningMethod):
 
 
 @register_conditioning_method(ConditioningMethodName.JAC_REV_GUIDANCE)
-@dataclass
+@dataclass(frozen=True)
 class JacRev(ConditioningMethod):
     """
     Uses full second moment approximation of the covariance of x_0|x_t.
@@ -326,25 +467,23 @@ class JacRev(ConditioningMethod):
     noise_std: float
     shape: tuple[int, ...]
 
-    @property
+    @cached_property
     def guidance_score_func(self) -> Callable[[Array, Array], Array]:
-        batch_batch_observation_map = vmap(vmap(self.observation_map))
-        estimate_h_x_0 = self.sde.get_estimate_x_0(self.observation_map)
-        estimate_h_x_0_vmap = self.sde.get_estimate_x_0_vmap(self.observation_map)
-        jacrev_vmap = vmap(jacrev(lambda x, t: estimate_h_x_0_vmap(x, t)[0]))
+        batch_batch_observation_map = _batch_batch(self.observation_map)
+        estimate_h_x_0_vmap = _remat(self.sde.get_estimate_x_0_vmap(self.observation_map))
+        jacrev_vmap = vmap(jacrev(_with_primal(estimate_h_x_0_vmap), has_aux=True))
+        noise_cov = self.noise_std**2 * jnp.eye(self.y.shape[1])
 
         # axes tuple for correct permutation of grad_H_x_0 array
         axes = (0,) + tuple(range(len(self.shape) + 1)[2:]) + (1,)
 
+        @jit
         def guidance_score(x, t):
-            h_x_0, (s, _) = estimate_h_x_0(
-                x, t
-            )  # TODO: in python 3.8 this line can be removed by utilizing has_aux=True
-            grad_H_x_0 = jacrev_vmap(x, t)
+            ratio_t = self.sde.ratio(t[0])
+            grad_H_x_0, (h_x_0, s) = jacrev_vmap(x, t)
+            h_x_0, s = h_x_0.reshape(self.y.shape), s.reshape(x.shape)
             H_grad_H_x_0 = batch_batch_observation_map(grad_H_x_0)
-            C_yy = self.sde.ratio(t[0]) * H_grad_H_x_0 + self.noise_std**2 * jnp.eye(
-                self.y.shape[1]
-            )
+            C_yy = ratio_t * H_grad_H_x_0 + noise_cov
             innovation = self.y - h_x_0
             f = batch_linalg_solve(C_yy, innovation)
             ls = batch_matmul(jnp.transpose(grad_H_x_0, axes), f).reshape(s.shape)
@@ -355,7 +494,7 @@ class JacRev(ConditioningMethod):
 
 
 @register_conditioning_method(ConditioningMethodName.JAC_FWD_GUIDANCE)
-@dataclass
+@dataclass(frozen=True)
 class JacFwd(ConditioningMethod):
     """
     Uses full second moment approximation of the covariance of x_0|x_t.
@@ -367,25 +506,23 @@ class JacFwd(ConditioningMethod):
     noise_std: float
     shape: tuple[int, ...]
 
-    @property
+    @cached_property
     def guidance_score_func(self) -> Callable[[Array, Array], Array]:
-        batch_batch_observation_map = vmap(vmap(self.observation_map))
-        estimate_h_x_0 = self.sde.get_estimate_x_0(self.observation_map)
+        batch_batch_observation_map = _batch_batch(self.observation_map)
         estimate_h_x_0_vmap = self.sde.get_estimate_x_0_vmap(self.observation_map)
 
         # axes tuple for correct permutation of grad_H_x_0 array
         axes = (0,) + tuple(range(len(self.shape) + 1)[2:]) + (1,)
-        jacfwd_vmap = vmap(jacfwd(lambda x, t: estimate_h_x_0_vmap(x, t)[0]))
+        jacfwd_vmap = vmap(jacfwd(_with_primal(estimate_h_x_0_vmap), has_aux=True))
+        noise_cov = self.noise_std**2 * jnp.eye(self.y.shape[1])
 
+        @jit
         def guidance_score(x, t):
-            h_x_0, (s, _) = estimate_h_x_0(
-                x, t
-            )  # TODO: in python 3.8 this line can be removed by utilizing has_aux=True
-            H_grad_x_0 = jacfwd_vmap(x, t)
+            ratio_t = self.sde.ratio(t[0])
+            H_grad_x_0, (h_x_0, s) = jacfwd_vmap(x, t)
+            h_x_0, s = h_x_0.reshape(self.y.shape), s.reshape(x.shape)
             H_grad_H_x_0 = batch_batch_observation_map(H_grad_x_0)
-            C_yy = self.sde.ratio(t[0]) * H_grad_H_x_0 + self.noise_std**2 * jnp.eye(
-                self.y.shape[1]
-            )
+            C_yy = ratio_t * H_grad_H_x_0 + noise_cov
             innovation = self.y - h_x_0
             f = batch_linalg_solve(C_yy, innovation)
             ls = batch_matmul(jnp.transpose(H_grad_x_0, axes), f).reshape(s.shape)
@@ -396,39 +533,52 @@ class JacFwd(ConditioningMethod):
 
 
 @register_conditioning_method(ConditioningMethodName.JAC_REV_GUIDANCE_DIAG)
-@dataclass
+@dataclass(frozen=True)
 class JacRevDiagonal(ConditioningMethod):
     """Use a diagonal approximation to the variance inside the likelihood,
     This produces similar results when the covariance is approximately diagonal
+
+    If `num_probes` is set, the diagonal is instead estimated with a Hutchinson estimator using
+    that many Rademacher probes (seeded by `seed` and the time), which only needs
+    `num_probes + 1` vjps rather than the full jacobian. The estimate is clamped at zero, as the
+    exact diagonal is non-negative. Its variance is high for few probes (relative errors of
+    several hundred percent with a single probe, around 10% with eight), so small `num_probes`
+    gives noisy guidance.
     """
 
     observation_map: Callable[[Array], Array]
     noise_std: float
     shape: tuple[int, ...]
+    num_probes: int | None = None
+    seed: int = 0
 
-    @property
+    @cached_property
     def guidance_score_func(self) -> Callable[[Array, Array], Array]:
-        estimate_h_x_0 = self.sde.get_estimate_x_0(self.observation_map)
-        batch_batch_observation_map = vmap(vmap(self.observation_map))
+        if self.num_probes is not None:
+            return _get_hutchinson_diagonal_guidance_score(self)
+
+        h_x_0_with_primal = _with_primal(_remat(self.sde.get_estimate_x_0(self.observation_map)))
+        batch_batch_observation_map = _batch_batch(self.observation_map)
 
         # axes tuple for correct permutation of grad_H_x_0 array
         axes = (0,) + tuple(range(len(self.shape) + 1)[2:]) + (1,)
 
         def vec_jacrev(x, t):
             return vmap(
-                jacrev(lambda _x: estimate_h_x_0(jnp.expand_dims(_x, axis=0), t.reshape(1, 1))[0])
+                jacrev(
+                    lambda _x: h_x_0_with_primal(jnp.expand_dims(_x, axis=0), t.reshape(1, 1)),
+                    has_aux=True,
+                )
             )(x)
 
+        @jit
         def guidance_score(x, t):
-            h_x_0, (s, _) = estimate_h_x_0(
-                x, t
-            )  # TODO: in python 3.8 this line can be removed by utilizing has_aux=True
-            grad_H_x_0 = jnp.squeeze(vec_jacrev(x, t[0]), axis=1)
+            ratio_t = self.sde.ratio(t[0])
+            grad_H_x_0, (h_x_0, s) = vec_jacrev(x, t[0])
+            grad_H_x_0 = jnp.squeeze(grad_H_x_0, axis=1)
+            h_x_0, s = h_x_0.reshape(self.y.shape), s.reshape(x.shape)
             H_grad_H_x_0 = batch_batch_observation_map(grad_H_x_0)
-            C_yy = (
-                self.sde.ratio(t[0]) * jnp.diagonal(H_grad_H_x_0, axis1=1, axis2=2)
-                + self.noise_std**2
-            )
+            C_yy = ratio_t * jnp.diagonal(H_grad_H_x_0, axis1=1, axis2=2) + self.noise_std**2
             innovation = self.y - h_x_0
             f = batch_mul(innovation, 1.0 / C_yy)
             ls = batch_matmul(jnp.transpose(grad_H_x_0, axes=axes), f).reshape(s.shape)
@@ -439,34 +589,37 @@ class JacRevDiagonal(ConditioningMethod):
 
 
 @register_conditioning_method(ConditioningMethodName.VJP_GUIDANCE_DIAG)
-@dataclass
+@dataclass(frozen=True)
 class VJPDiagonal(ConditioningMethod):
     """
     Uses full second moment approximation of the covariance of x_0|x_t.
 
-    Computes using H.shape[0] vjps.
+    Computes using H.shape[0] vjps, evaluated in parallel. Set `vjp_chunk_size` to instead
+    evaluate them sequentially in chunks of that size, to bound peak memory.
     """
 
     H: Array
     noise_std: float
     shape: tuple[int, ...]
+    vjp_chunk_size: int | None = None
 
-    @property
+    @cached_property
     def guidance_score_func(self) -> Callable[[Array, Array], Array]:
         # TODO: necessary to use shape here?
-        estimate_x_0 = self.sde.get_estimate_x_0(lambda x: x, shape=(self.shape[0], -1))
-        batch_H = jnp.transpose(jnp.tile(self.H, (self.shape[0], 1, 1)), axes=(1, 0, 2))
+        estimate_x_0 = _remat(self.sde.get_estimate_x_0(lambda x: x, shape=(self.shape[0], -1)))
 
+        @jit
         def guidance_score(x, t):
+            ratio_t = self.sde.ratio(t[0])
             x_0, vjp_x_0, (s, _) = vjp(lambda x: estimate_x_0(x, t), x, has_aux=True)
-            vec_vjp_x_0 = vmap(vjp_x_0)
-            H_grad_x_0 = vec_vjp_x_0(batch_H)[0]
-            H_grad_x_0 = H_grad_x_0.reshape(self.H.shape[0], self.shape[0], self.H.shape[1])
-            diag_H_grad_H_x_0 = jnp.sum(batch_mul_A(self.H, H_grad_x_0.transpose(1, 0, 2)), axis=-1)
-            C_yy = self.sde.ratio(t[0]) * diag_H_grad_H_x_0 + self.noise_std**2
-            innovation = self.y - batch_matmul_A(self.H, x_0)
-            f = batch_mul(innovation, 1.0 / C_yy)
-            ls = vjp_x_0(batch_matmul_A(self.H.T, f))[0]
+            H_grad_x_0 = chunked_map(
+                _broadcast_vjp(vjp_x_0, (self.shape[0], self.H.shape[1])),
+                self.H,
+                self.vjp_chunk_size,
+            )
+            diag_H_grad_H_x_0 = jnp.einsum("ij,ibj->bi", self.H, H_grad_x_0)
+            C_yy = ratio_t * diag_H_grad_H_x_0 + self.noise_std**2
+            ls = vjp_x_0(((self.y - batch_matmul_A(self.H, x_0)) / C_yy) @ self.H)[0]
             gs = s + ls
             return gs
 
@@ -474,38 +627,51 @@ class VJPDiagonal(ConditioningMethod):
 
 
 @register_conditioning_method(ConditioningMethodName.JAC_FWD_GUIDANCE_DIAG)
-@dataclass
+@dataclass(frozen=True)
 class JacFwdDiagonal(ConditioningMethod):
     """Use a diagonal approximation to the variance inside the likelihood,
     This produces similar results when the covariance is approximately diagonal
+
+    If `num_probes` is set, the diagonal is instead estimated with a Hutchinson estimator using
+    that many Rademacher probes (seeded by `seed` and the time), which only needs
+    `num_probes + 1` vjps rather than the full jacobian. The estimate is clamped at zero, as the
+    exact diagonal is non-negative. Its variance is high for few probes (relative errors of
+    several hundred percent with a single probe, around 10% with eight), so small `num_probes`
+    gives noisy guidance.
     """
 
     observation_map: Callable[[Array], Array]
     noise_std: float
     shape: tuple[int, ...]
+    num_probes: int | None = None
+    seed: int = 0
 
-    @property
+    @cached_property
     def guidance_score_func(self) -> Callable[[Array, Array], Array]:
-        batch_batch_observation_map = vmap(vmap(self.observation_map))
-        estimate_h_x_0 = self.sde.get_estimate_x_0(self.observation_map)
+        if self.num_probes is not None:
+            return _get_hutchinson_diagonal_guidance_score(self)
+
+        batch_batch_observation_map = _batch_batch(self.observation_map)
+        h_x_0_with_primal = _with_primal(self.sde.get_estimate_x_0(self.observation_map))
         # axes tuple for correct permutation of grad_H_x_0 array
         axes = (0,) + tuple(range(len(self.shape) + 1)[2:]) + (1,)
 
         def vec_jacfwd(x, t):
             return vmap(
-                jacfwd(lambda _x: estimate_h_x_0(jnp.expand_dims(_x, axis=0), t.reshape(1, 1))[0])
+                jacfwd(
+                    lambda _x: h_x_0_with_primal(jnp.expand_dims(_x, axis=0), t.reshape(1, 1)),
+                    has_aux=True,
+                )
             )(x)
 
+        @jit
         def guidance_score(x, t):
-            h_x_0, (s, _) = estimate_h_x_0(
-                x, t
-            )  # TODO: in python 3.8 this line can be removed by utilizing has_aux=True
-            H_grad_x_0 = jnp.squeeze(vec_jacfwd(x, t[0]), axis=(1))
+            ratio_t = self.sde.ratio(t[0])
+            H_grad_x_0, (h_x_0, s) = vec_jacfwd(x, t[0])
+            H_grad_x_0 = jnp.squeeze(H_grad_x_0, axis=1)
+            h_x_0, s = h_x_0.reshape(self.y.shape), s.reshape(x.shape)
             H_grad_H_x_0 = batch_batch_observation_map(H_grad_x_0)
-            C_yy = (
-                self.sde.ratio(t[0]) * jnp.diagonal(H_grad_H_x_0, axis1=1, axis2=2)
-                + self.noise_std**2
-            )
+            C_yy = ratio_t * jnp.diagonal(H_grad_H_x_0, axis1=1, axis2=2) + self.noise_std**2
             f = batch_mul(self.y - h_x_0, 1.0 / C_yy)
             ls = batch_matmul(jnp.transpose(H_grad_x_0, axes=axes), f).reshape(s.shape)
             gs = s + ls
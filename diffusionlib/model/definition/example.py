@@ -1,12 +1,17 @@
+from typing import Any
+
 import equinox as eqx
 import flax.linen as nn
 import jax
 import jax.numpy as jnp
 import jax.random as random
 import numpy as np
+from jax import lax
 from jaxtyping import Array, Float, PRNGKeyArray, PyTree
 from optax import GradientTransformation
 
+from diffusionlib.util.compilation import enable_compilation_cache
+
 
 class MLP(nn.Module):
     @nn.compact
@@ -51,14 +56,26 @@ class CNN(nn.Module):
         return x
 
 
+def time_fourier_features(t: Float[Array, "b 1"]) -> Float[Array, "b 4"]:
+    return jnp.concatenate(
+        [t - 0.5, jnp.cos(2 * jnp.pi * t), jnp.sin(2 * jnp.pi * t), -jnp.cos(4 * jnp.pi * t)],
+        axis=-1,
+    )
+
+
 class FullyConnectedWithTime(eqx.Module):
     """A simple model with multiple fully connected layers and some fourier features for the time
-    variable.
+    variable. Operates directly on a batch of inputs.
+
+    Parameters are kept in full precision, but the forward pass is computed in `compute_dtype`,
+    with outputs cast back to the input dtype. This is float32 by default; bfloat16 can be used to
+    speed up training, but its jacobians are too inaccurate for the covariance solves in guidance.
     """
 
     layers: list[eqx.nn.Linear]
+    compute_dtype: Any = eqx.field(static=True)
 
-    def __init__(self, in_size: int, key: PRNGKeyArray):
+    def __init__(self, in_size: int, key: PRNGKeyArray, compute_dtype: Any = jnp.float32):
         key1, key2, key3, key4 = jax.random.split(key, 4)
         out_size = in_size
 
@@ -68,33 +85,61 @@ class FullyConnectedWithTime(eqx.Module):
             eqx.nn.Linear(256, 256, key=key3),
             eqx.nn.Linear(256, out_size, key=key4),
         ]
+        self.compute_dtype = compute_dtype
+
+    def __call__(
+        self,
+        x: Float[Array, "b n"],
+        t: Float[Array, "b 1"],
+        t_fourier: Float[Array, "b 4"] | None = None,
+    ) -> Float[Array, "b n"]:
+        """Apply the model. `t_fourier` can be given to skip recomputing the (precomputed)
+        fourier features of `t`.
+        """
+        out_dtype = x.dtype
+        if t_fourier is None:
+            t_fourier = time_fourier_features(t)
+
+        x = jnp.concatenate([x, t_fourier], axis=-1).astype(self.compute_dtype)
+
+        # Apply the layers to the whole batch at once (one GEMM per layer rather than vmapped
+        # mat-vecs)
+        for layer in self.layers[:-1]:
+            x = jax.nn.relu(self._linear(layer, x))
 
-    def __call__(self, x: Array, t: Array) -> Float[Array, "2"]:
-        t_fourier = jnp.array(
-            [t - 0.5, jnp.cos(2 * jnp.pi * t), jnp.sin(2 * jnp.pi * t), -jnp.cos(4 * jnp.pi * t)],
-        ).squeeze(-1)
-
-        x = jnp.concatenate([x, t_fourier])
+        x = self._linear(self.layers[-1], x)
 
-        for layer in self.layers[:-1]:
-            x = jax.nn.relu(layer(x))
+        return x.astype(out_dtype)
 
-        x = self.layers[-1](x)
+    def _linear(self, layer: eqx.nn.Linear, x: Array) -> Array:
+        weight = layer.weight.astype(self.compute_dtype)
+        bias = layer.bias.astype(self.compute_dtype)
 
-        return x
+        return x @ weight.T + bias
 
 
 @jax.jit
 @jax.value_and_grad
-def loss(model: FullyConnectedWithTime, data: Array, alpha_bar: Array, rng) -> Float[Array, ""]:
+def loss(
+    model: FullyConnectedWithTime,
+    data: Array,
+    alpha_bar: Array,
+    rng,
+    t_fourier_table: Array | None = None,
+) -> Float[Array, ""]:
     key1, key2 = random.split(rng, 2)
 
-    r_alpha_bar = random.choice(key1, alpha_bar, (data.shape[0], 1))
+    if t_fourier_table is None:
+        t_fourier_table = time_fourier_features(alpha_bar[:, None])
+
+    idx = random.randint(key1, (data.shape[0],), 0, alpha_bar.shape[0])
+    r_alpha_bar = alpha_bar[idx][:, None]
+    t_fourier = t_fourier_table[idx]
 
     noise = random.normal(key2, data.shape)
     noised_data = data * r_alpha_bar**0.5 + noise * (1 - r_alpha_bar) ** 0.5
 
-    output = jax.vmap(model)(noised_data, r_alpha_bar)
+    output = model(noised_data, r_alpha_bar, t_fourier)
 
     loss = jnp.mean((noise - output) ** 2)
 
@@ -109,37 +154,75 @@ def fit(
     alpha_bar: Array,
     rng: PRNGKeyArray,
     print_every: int = 5_000,
+    compilation_cache: bool = True,
 ) -> FullyConnectedWithTime:
-    opt_state = optimizer.init(eqx.filter(model, eqx.is_array))
-    losses: list[Float] = []
+    """Train `model` to predict the noise added to `data` at the noise levels in `alpha_bar`.
+
+    Args:
+        model (FullyConnectedWithTime): Model to train. It is copied, so is left unchanged.
+        steps (int): Number of training steps.
+        optimizer (GradientTransformation): Optimizer to train with.
+        data (Array): Training data.
+        alpha_bar (Array): Noise schedule to sample noise levels from.
+        rng (PRNGKeyArray): Random key.
+        print_every (int, optional): Number of steps to run between printing the average training
+            loss. Defaults to 5_000.
+        compilation_cache (bool, optional): Whether to enable JAX's persistent compilation cache
+            with `enable_compilation_cache`. Note this updates the global `jax.config` (including
+            caching executables of any size), so applies to everything compiled afterwards in
+            the process. Defaults to True.
+
+    Returns:
+        FullyConnectedWithTime: Trained model.
+    """
+    if compilation_cache:
+        enable_compilation_cache()
 
-    @eqx.filter_jit
-    def make_step(
+    # make_steps donates the model's buffers, so work on a copy to leave the caller's model intact
+    model = jax.tree_util.tree_map(lambda x: jnp.copy(x) if eqx.is_array(x) else x, model)
+    opt_state = optimizer.init(eqx.filter(model, eqx.is_array))
+    # alpha_bar only takes a finite set of values, so its fourier features are computed once
+    t_fourier_table = time_fourier_features(alpha_bar[:, None])
+
+    # Only the model and optimizer state are donated (the first argument is not), so XLA can
+    # update their buffers in place
+    @eqx.filter_jit(donate="all-except-first")
+    def make_steps(
+        inputs: tuple[Array, Array, Array, PRNGKeyArray],
         model: FullyConnectedWithTime,
         opt_state: PyTree,
-        data: Array,
-        alpha_bar: Array,
-        step_rng: PRNGKeyArray,
     ):
-        loss_value, grads = loss(model, data, alpha_bar, step_rng)
-        updates, opt_state = optimizer.update(grads, opt_state, model)
-        model = eqx.apply_updates(model, updates)
+        data, alpha_bar, t_fourier_table, step_rngs = inputs
+        params, static = eqx.partition(model, eqx.is_array)
+
+        def make_step(carry, step_rng):
+            params, opt_state, loss_sum = carry
+            model = eqx.combine(params, static)
+            loss_value, grads = loss(model, data, alpha_bar, step_rng, t_fourier_table)
+            updates, opt_state = optimizer.update(grads, opt_state, model)
+            params = eqx.apply_updates(params, updates)
+
+            return (params, opt_state, loss_sum + loss_value), None
+
+        # Run a whole chunk of steps in a single scan so there is no per-step dispatch/host sync;
+        # the loss is accumulated on-device in the carry
+        (params, opt_state, loss_sum), _ = lax.scan(
+            make_step, (params, opt_state, jnp.zeros(())), step_rngs
+        )
 
-        return model, opt_state, loss_value
+        return eqx.combine(params, static), opt_state, loss_sum
 
-    for step in range(steps):
-        step_rng, rng = random.split(rng, 2)
-        model, opt_state, train_loss = make_step(
+    for start in range(0, steps, print_every):
+        n_steps = min(print_every, steps - start)
+        chunk_rng, rng = random.split(rng, 2)
+        model, opt_state, train_loss_sum = make_steps(
+            (data, alpha_bar, t_fourier_table, random.split(chunk_rng, n_steps)),
             model,
             opt_state,
-            data,
-            alpha_bar,
-            step_rng,
         )
-        losses.append(train_loss)
 
-        if (step % print_every) == 0 or (step == steps - 1):
-            mean_loss = jnp.mean(jnp.array(losses))
-            print(f"{step=},\t avg_train_loss={mean_loss}")
+        step = start + n_steps - 1
+        mean_loss = float(train_loss_sum / n_steps)
+        print(f"{step=},\t avg_train_loss={mean_loss}")
 
     return model
@@ -0,0 +1,27 @@
+"""Functions related to JAX/XLA compilation."""
+
+import os
+
+import jax
+
+
+def enable_compilation_cache(cache_dir: str | None = None, min_compile_time_secs: float = 1.0):
+    """Enable JAX's persistent compilation cache, so compiled functions (e.g. training steps and
+    guidance scores) are reloaded from disk rather than recompiled in subsequent processes.
+
+    Does nothing if a cache directory has already been configured (e.g. via the
+    `JAX_COMPILATION_CACHE_DIR` environment variable).
+
+    Args:
+        cache_dir (str | None, optional): Directory to store compiled executables in. Defaults to
+            the `JAX_CACHE` environment variable if set, else `~/.cache/jax`.
+        min_compile_time_secs (float, optional): Only cache executables which took at least this
+            long to compile. Defaults to 1.0.
+    """
+    if jax.config.jax_compilation_cache_dir:
+        return
+
+    cache_dir = cache_dir or os.environ.get("JAX_CACHE", "~/.cache/jax")
+    jax.config.update("jax_compilation_cache_dir", os.path.expanduser(cache_dir))
+    jax.config.update("jax_persistent_cache_min_entry_size_bytes", 0)
+    jax.config.update("jax_persistent_cache_min_compile_time_secs", min_compile_time_secs)
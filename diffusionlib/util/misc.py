@@ -1,9 +1,12 @@
 """Utility functions, including all functions related to
 loss computation, optimization and sampling.
 """
+from typing import Callable
+
 import jax.numpy as jnp
 import jax.random as random
-from jax import vmap
+from jax import lax, vmap
+from jax.scipy.linalg import cho_factor, cho_solve
 from jaxtyping import Array
 
 
@@ -116,6 +119,14 @@ def batch_linalg_solve_A(A, b):
     return vmap(lambda b: jnp.linalg.solve(A, b))(b)
 
 
+def batch_cho_solve_A(A, b):
+    """Solve `A x = b_i` for each row `b_i` of `b`, for a single symmetric positive definite `A`.
+
+    `A` is factorised once, rather than per row of `b`.
+    """
+    return cho_solve(cho_factor(A, lower=True), b.T).T
+
+
 def batch_linalg_solve(A, b):
     return vmap(jnp.linalg.solve)(A, b)
 
@@ -136,6 +147,34 @@ def batch_matmul_A(A, b):
     return vmap(lambda b: A @ b)(b)
 
 
+def chunked_map(f: Callable[[Array], Array], xs: Array, chunk_size: int | None = None) -> Array:
+    """Map `f` over the leading axis of `xs`, vmapping over `chunk_size` elements at a time and
+    mapping over the chunks sequentially. Smaller chunks trade parallelism for peak memory.
+
+    Args:
+        f (Callable[[Array], Array]): Function to map.
+        xs (Array): Array to map over the leading axis of.
+        chunk_size (int | None, optional): Number of elements to vmap over at once. Defaults to
+            None, in which case all elements are vmapped over at once, as in `vmap(f)(xs)`.
+
+    Returns:
+        Array: Stacked outputs of `f`.
+    """
+    n = xs.shape[0]
+
+    if chunk_size is None or chunk_size >= n:
+        return vmap(f)(xs)
+
+    if chunk_size <= 1:
+        return lax.map(f, xs)
+
+    n_chunks = -(-n // chunk_size)
+    xs = jnp.pad(xs, [(0, n_chunks * chunk_size - n)] + [(0, 0)] * (xs.ndim - 1))
+    ys = lax.map(vmap(f), xs.reshape((n_chunks, chunk_size) + xs.shape[1:]))
+
+    return ys.reshape((n_chunks * chunk_size,) + ys.shape[2:])[:n]
+
+
 def errors(t, sde, score, rng, data, likelihood_weighting=True):
     """
     Args: